@@ -1364,6 +1364,49 @@ func (e *ETLService) ProcessETLFromSQL(query string) error {
 	return nil
 }
 
+// sourceFilesFromEnv returns the files listed in ETL_SOURCE_FILES (a JSON array,
+// so file names may contain any character), falling back to the single ETL_SOURCE_FILE
+func sourceFilesFromEnv() ([]string, error) {
+	var files []string
+	if raw := os.Getenv("ETL_SOURCE_FILES"); raw != "" {
+		if err := json.Unmarshal([]byte(raw), &files); err != nil {
+			return nil, fmt.Errorf("ETL_SOURCE_FILES must be a JSON array of paths: %v", err)
+		}
+	}
+	if len(files) == 0 {
+		files = append(files, os.Getenv("ETL_SOURCE_FILE"))
+	}
+	return files, nil
+}
+
+// fileResultPrefix marks the per-file result lines that callers parse from stdout
+const fileResultPrefix = "ETL_FILE_RESULT "
+
+type fileResult struct {
+	File   string `json:"file"`
+	Status string `json:"status"`
+	Error  string `json:"error,omitempty"`
+}
+
+// processFiles runs process on every file, carrying on past failures so one bad
+// file does not abort the batch. It prints one result line per file and returns
+// the number of files that failed.
+func processFiles(filePaths []string, process func(string) error) int {
+	failed := 0
+	for _, filePath := range filePaths {
+		result := fileResult{File: filePath, Status: "ingested"}
+		if err := process(filePath); err != nil {
+			log.Printf("ETL failed for %s: %v", filePath, err)
+			result.Status = "failed"
+			result.Error = err.Error()
+			failed++
+		}
+		line, _ := json.Marshal(result)
+		fmt.Println(fileResultPrefix + string(line))
+	}
+	return failed
+}
+
 func main() {
 	// Get environment variables
 	minioEndpoint := os.Getenv("MINIO_ENDPOINT")
@@ -1385,15 +1428,18 @@ func main() {
 	sourceType := os.Getenv("ETL_SOURCE_TYPE") // "file" or "sql"
 	
 	if sourceType == "file" {
-		filePath := os.Getenv("ETL_SOURCE_FILE")
+		filePaths, err := sourceFilesFromEnv()
+		if err != nil {
+			log.Fatal(err)
+		}
+		process := etl.ProcessETLFromFile
 		if os.Getenv("ETL_MODE") == "star" || os.Getenv("ETL_COMMAND") == "ingest-orders-csv" {
-			if err := etl.IngestOrdersCSV(filePath); err != nil {
-				log.Fatalf("ETL star ingestion failed: %v", err)
-			}
-			return
+			process = etl.IngestOrdersCSV
 		}
-		if err := etl.ProcessETLFromFile(filePath); err != nil {
-			log.Fatalf("ETL process failed: %v", err)
+		if failed := processFiles(filePaths, process); failed > 0 {
+			// log.Fatalf would skip the deferred db.Close
+			etl.db.Close()
+			log.Fatalf("ETL failed for %d of %d file(s)", failed, len(filePaths))
 		}
 	} else if sourceType == "sql" {
 		query := os.Getenv("ETL_SOURCE_QUERY")
@@ -1,6 +1,4 @@
 #!/usr/bin/env python3
-import http.server
-import socketserver
 import os
 import webbrowser
 from pathlib import Path
@@ -11,73 +9,75 @@ from email.mime.base import MIMEBase
 from email import encoders
 import io
 
-class UploadHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+from upload_support import (
+    BaseUploadHTTPRequestHandler,
+    PooledTCPServer,
+    SpooledUpload,
+    env_positive_int,
+    has_disk_room,
+    json_bytes,
+    multipart_boundary,
+    parse_content_disposition,
+    read_multipart,
+)
+
+WEB_DIR = Path(__file__).parent / "web-upload"
+UPLOAD_DIR = Path(__file__).parent / "uploads"
+UPLOAD_DIR.mkdir(exist_ok=True)
+
+# Pre-encoded success replies for the common small upload counts
+_OK_TEMPLATES = {
+    i: f'{{"success": true, "message": "Successfully uploaded {i} file(s)"}}'.encode()
+    for i in range(16)
+}
+
+class UploadHTTPRequestHandler(BaseUploadHTTPRequestHandler):
+    # Keep connections open between requests; every reply sets Content-Length
+    protocol_version = "HTTP/1.1"
+
     def __init__(self, *args, **kwargs):
-        super().__init__(*args, directory=Path(__file__).parent / "web-upload", **kwargs)
+        super().__init__(*args, directory=str(WEB_DIR), **kwargs)
     
-    def do_POST(self):
-        if self.path == '/upload':
-            self.handle_file_upload()
-        else:
-            # Handle other POST requests with 404
-            self.send_error(404, "Not Found")
+    def upload_refusal(self, content_length):
+        # Checked before the body is read, when the disk is nearly full
+        if not has_disk_room(UPLOAD_DIR, content_length):
+            return "Not enough disk space for upload, retry later"
+        return None
     
     def handle_file_upload(self):
         try:
             # Get content length
             content_length = int(self.headers['Content-Length'])
             
-            # Read the body
-            post_data = self.rfile.read(content_length)
-            
-            # Parse multipart form data manually
-            boundary = self.headers['Content-Type'].split('boundary=')[1].encode()
-            parts = post_data.split(b'--' + boundary)
+            # Parse multipart form data while streaming the body to disk
+            boundary = multipart_boundary(self.headers)
             
-            uploaded_count = 0
             files = []
             
-            for part in parts[1:-1]:  # Skip first and last empty parts
-                # Split headers and body
-                if b'\r\n\r\n' in part:
-                    headers, body = part.split(b'\r\n\r\n', 1)
-                    
-                    # Parse headers to find Content-Disposition
-                    headers_str = headers.decode('utf-8', errors='ignore')
-                    
-                    if 'filename=' in headers_str.lower():
-                        # Extract filename from Content-Disposition header
-                        start = headers_str.find('filename="')
-                        if start != -1:
-                            start += 10  # length of 'filename="'
-                            end = headers_str.find('"', start)
-                            if end != -1:
-                                filename = headers_str[start:end]
-                                
-                                # Remove trailing \r\n from body
-                                if body.endswith(b'\r\n'):
-                                    body = body[:-2]
-                                
-                                files.append((filename, body))
-                                uploaded_count += 1
-            
-            # Process each file
-            for filename, file_content in files:
+            def open_part(headers):
+                # Parse headers to find Content-Disposition
+                _, filename = parse_content_disposition(headers)
+                filename = os.path.basename(filename or '')
+                if not filename:
+                    return None
+                
                 # In a real implementation, you would upload to MinIO here
                 # For now, we'll just save to local directory
-                upload_dir = Path(__file__).parent / "uploads"
-                upload_dir.mkdir(exist_ok=True)
-                
-                file_path = upload_dir / filename
-                with open(file_path, 'wb') as f:
-                    f.write(file_content)
+                files.append(filename)
+                return SpooledUpload(UPLOAD_DIR / filename)
+            
+            read_multipart(self.rfile, content_length, boundary, open_part)
+            
+            uploaded_count = len(files)
         
             # Send success response
+            response = _OK_TEMPLATES.get(uploaded_count) or json_bytes(
+                {"success": True, "message": f"Successfully uploaded {uploaded_count} file(s)"})
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
+            self.send_header('Content-Length', str(len(response)))
             self.end_headers()
-            response = f'{{"success": true, "message": "Successfully uploaded {uploaded_count} file(s)"}}'
-            self.wfile.write(response.encode())
+            self.wfile.write(response)
             
         except Exception as e:
             print(f"Upload error: {str(e)}")
@@ -89,7 +89,11 @@ def start_server():
     # Create a custom handler that serves files from web-upload directory
     Handler = UploadHTTPRequestHandler
     
-    with socketserver.TCPServer(("", port), Handler) as httpd:
+    # Worker pool size, see README
+    max_workers = env_positive_int("UPLOAD_SERVER_WORKERS", PooledTCPServer.max_workers)
+    max_pending = env_positive_int("UPLOAD_SERVER_PENDING", PooledTCPServer.max_pending)
+    
+    with PooledTCPServer(("", port), Handler, max_workers=max_workers, max_pending=max_pending) as httpd:
         print(f"Web interface started at http://localhost:{port}/minimal_upload.html")
         print("Press Ctrl+C to stop the server")
         
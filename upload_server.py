@@ -1,128 +1,330 @@
 #!/usr/bin/env python3
-import http.server
-import socketserver
+import json
 import os
-import cgi
 from pathlib import Path
-import tempfile
-import json
+import shutil
 import traceback
 import subprocess
+import queue
+import threading
+import uuid
+
+from upload_support import (
+    BaseUploadHTTPRequestHandler,
+    PooledTCPServer,
+    SpooledUpload,
+    env_positive_int,
+    has_disk_room,
+    multipart_boundary,
+    parse_content_disposition,
+    read_multipart,
+)
+
+BASE_DIR = Path(__file__).parent
+WEB_DIR = BASE_DIR / "web-upload"
+UPLOAD_DIR = BASE_DIR / "uploads"
+UPLOAD_DIR.mkdir(exist_ok=True)
+# Uploads smaller than TMPFS_MAX_UPLOAD are staged in RAM-backed /dev/shm
+# (when present) and mounted into the ETL container from there
+SHM_UPLOAD_DIR = Path("/dev/shm/uploads")
+TMPFS_MAX_UPLOAD = 100 << 20
+try:
+    SHM_UPLOAD_DIR.mkdir(exist_ok=True)
+    SHM_AVAILABLE = True
+except OSError:
+    SHM_AVAILABLE = False
+
+# Uploaded files are ingested by a background worker so the HTTP handler
+# can answer as soon as the files are on disk. Job state is kept in
+# ingest_jobs and exposed at /status/<job_id>.
+ingest_queue = queue.Queue()
+# Uploads are refused while this many ingest jobs are waiting
+MAX_PENDING_INGESTS = 32
+# Finished jobs beyond this many are forgotten, oldest first
+MAX_TRACKED_JOBS = 1000
+# Only the tail of a failed run's stderr is kept with the job
+MAX_ERROR_CHARS = 4096
+ingest_jobs = {}
+ingest_jobs_lock = threading.Lock()
+
+
+def _update_job(job_id, **fields):
+    with ingest_jobs_lock:
+        ingest_jobs[job_id].update(fields)
+
+
+def _forget_finished_jobs():
+    # Caller holds ingest_jobs_lock; dicts keep insertion order, so the
+    # oldest jobs come first. Queued and running jobs are always kept.
+    excess = len(ingest_jobs) - MAX_TRACKED_JOBS
+    if excess <= 0:
+        return
+    finished = []
+    for job_id, job in ingest_jobs.items():
+        if job["status"] not in ("queued", "running"):
+            finished.append(job_id)
+            if len(finished) == excess:
+                break
+    for job_id in finished:
+        del ingest_jobs[job_id]
+
+
+# etl-go prints one "ETL_FILE_RESULT {json}" line per file it processed
+ETL_RESULT_PREFIX = "ETL_FILE_RESULT "
+
+
+def _file_results(stdout, filenames, error=None):
+    # A file without a result line failed with the run's error when the run
+    # stopped early; after a clean exit there is no evidence either way
+    reported = {}
+    for line in (stdout or "").splitlines():
+        if line.startswith(ETL_RESULT_PREFIX):
+            try:
+                result = json.loads(line[len(ETL_RESULT_PREFIX):])
+            except ValueError:
+                continue
+            reported[result.get("file")] = result
+    results = []
+    for name in filenames:
+        result = reported.get(f"/app/uploads/{name}")
+        if result is None:
+            if error is None:
+                results.append({"file": name, "status": "unknown"})
+            else:
+                results.append({"file": name, "status": "failed", "error": error})
+        else:
+            entry = {"file": name, "status": result.get("status", "failed")}
+            if result.get("error"):
+                entry["error"] = result["error"]
+            results.append(entry)
+    return results
+
+
+def _job_status(results):
+    statuses = {r["status"] for r in results}
+    if statuses == {"ingested"}:
+        return "done"
+    if "failed" not in statuses:
+        return "unknown"
+    return "partial" if "ingested" in statuses else "failed"
+
+
+def _run_ingest(job_dir, filenames):
+    # Trigger one ETL ingestion into star schema via docker compose + etl-go
+    # for the whole batch, so each upload pays for a single container start.
+    # The file list goes as a JSON array so names may contain any character.
+    source_files = json.dumps([f"/app/uploads/{name}" for name in filenames])
+    try:
+        cmd = [
+            "docker", "compose", "run", "--rm",
+            "-e", "ETL_SOURCE_TYPE=file",
+            "-e", f"ETL_SOURCE_FILES={source_files}",
+            "-e", "ETL_MODE=star",
+            "-v", f"{job_dir}:/app/uploads",
+            "etl-go"
+        ]
+        result = subprocess.run(
+            cmd,
+            cwd=BASE_DIR,
+            capture_output=True,
+            text=True,
+            check=True
+        )
+        results = _file_results(result.stdout, filenames)
+        return {"status": _job_status(results), "results": results}
+    except (subprocess.CalledProcessError, OSError) as etl_err:
+        # etl-go carries on past a bad file, so part of the batch may be in;
+        # per-file results let clients retry only the files that failed
+        error = (getattr(etl_err, "stderr", None) or str(etl_err))[-MAX_ERROR_CHARS:]
+        results = _file_results(getattr(etl_err, "stdout", None), filenames, error)
+        return {
+            "status": _job_status(results),
+            "error": error,
+            "results": results
+        }
+
+
+def staging_dir(content_length):
+    if content_length < TMPFS_MAX_UPLOAD and SHM_AVAILABLE:
+        if has_disk_room(SHM_UPLOAD_DIR, content_length):
+            return SHM_UPLOAD_DIR
+    return UPLOAD_DIR
+
+
+def unique_name(filename, taken):
+    # Parts sharing a name in one upload (e.g. data.csv from two folders) are
+    # saved as data.csv, data-2.csv, ... so neither replaces the other
+    stem, ext = os.path.splitext(filename)
+    candidate, n = filename, 1
+    while candidate in taken:
+        n += 1
+        candidate = f"{stem}-{n}{ext}"
+    taken.add(candidate)
+    return candidate
+
 
-class UploadHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+def _release_staged(job_dir):
+    # Files staged in RAM are only needed until the ingest attempt is over,
+    # whatever its outcome; leaving failed jobs there would slowly fill RAM
+    if job_dir.parent == SHM_UPLOAD_DIR:
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+
+def sweep_stale_staging():
+    # The ingest queue lives in memory, so job directories left in RAM by a
+    # previous run can no longer be ingested or released by anyone
+    if not SHM_AVAILABLE:
+        return
+    for entry in SHM_UPLOAD_DIR.iterdir():
+        if entry.is_dir():
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+def ingest_worker():
+    while True:
+        job_id, job_dir, filenames = ingest_queue.get()
+        try:
+            _update_job(job_id, status="running")
+            result = _run_ingest(job_dir, filenames)
+            _update_job(job_id, **result)
+        except Exception as e:
+            traceback.print_exc()
+            _update_job(job_id, status="failed", error=str(e))
+        finally:
+            _release_staged(job_dir)
+            ingest_queue.task_done()
+
+
+def start_ingest_worker():
+    worker = threading.Thread(target=ingest_worker, name="ingest-worker", daemon=True)
+    worker.start()
+    return worker
+
+
+def enqueue_ingest(job_id, job_dir, filenames):
+    with ingest_jobs_lock:
+        ingest_jobs[job_id] = {"id": job_id, "status": "queued", "files": list(filenames)}
+        _forget_finished_jobs()
+    ingest_queue.put((job_id, job_dir, list(filenames)))
+
+
+class UploadHTTPRequestHandler(BaseUploadHTTPRequestHandler):
     server_version = "UploadHTTP/1.0"
+    # Keep connections open for status polling; every reply sets Content-Length
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory=str(WEB_DIR), **kwargs)
 
-    def _set_cors(self):
+    def send_response(self, code, message=None):
+        super().send_response(code, message)
+        # Every reply, including errors and static files, carries CORS headers
         self.send_header("Access-Control-Allow-Origin", "*")
-        self.send_header("Access-Control-Allow-Methods", "POST, OPTIONS")
+        self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
         self.send_header("Access-Control-Allow-Headers", "Content-Type")
 
     def do_OPTIONS(self):
         self.send_response(204, "No Content")
-        self._set_cors()
+        self.send_header('Content-Length', '0')
         self.end_headers()
 
-    def do_POST(self):
-        if self.path == '/upload':
-            self.handle_file_upload()
+    def do_GET(self):
+        if self.path.startswith('/status/'):
+            self.handle_status(self.path[len('/status/'):])
         else:
-            self.send_error(404, "Not Found")
-    
+            super().do_GET()
+
+    def handle_status(self, job_id):
+        with ingest_jobs_lock:
+            job = ingest_jobs.get(job_id)
+            job = dict(job) if job is not None else None
+        if job is None:
+            self.send_json(404, {"success": False, "error": f"Unknown job '{job_id}'"})
+            return
+        self.send_json(200, job)
+
+    def upload_refusal(self, content_length):
+        # Checked before the body is read, when the disk or the ingest
+        # backlog is already saturated
+        if ingest_queue.qsize() >= MAX_PENDING_INGESTS:
+            return "Too many files waiting for ingestion, retry later"
+        if not has_disk_room(staging_dir(content_length), content_length):
+            return "Not enough disk space for upload, retry later"
+        return None
+
     def handle_file_upload(self):
         try:
-            form = cgi.FieldStorage(
-                fp=self.rfile,
-                headers=self.headers,
-                environ={
-                    'REQUEST_METHOD': 'POST',
-                    'CONTENT_TYPE': self.headers.get('Content-Type', '')
-                }
-            )
+            content_length = int(self.headers['Content-Length'])
 
+            upload_dir = staging_dir(content_length)
+            boundary = multipart_boundary(self.headers)
+
+            # Every upload gets its own directory, so files with the same
+            # name in concurrent or queued uploads never replace each other.
+            # Each part is saved as soon as it is complete; only the part being
+            # received is held in memory, and only up to SPOOL_MAX_SIZE
+            job_id = uuid.uuid4().hex
+            job_dir = upload_dir / job_id
+            job_dir.mkdir()
             uploaded_files = []
-            if form.list:
-                for part in form.list:
-                    if isinstance(part, cgi.FieldStorage) and getattr(part, "filename", ""):
-                        if part.name == "files":
-                            uploaded_files.append(part)
+            taken_names = set()
+
+            def open_part(headers):
+                name, filename = parse_content_disposition(headers)
+                if name != "files" or not filename:
+                    return None
+                filename = unique_name(os.path.basename(filename) or "uploaded_file", taken_names)
+                spool = SpooledUpload(job_dir / filename)
+                uploaded_files.append((filename, spool))
+                return spool
+
+            try:
+                read_multipart(self.rfile, content_length, boundary, open_part)
+            except Exception:
+                # Drop the parts saved before the body failed
+                shutil.rmtree(job_dir, ignore_errors=True)
+                raise
 
             if not uploaded_files:
+                job_dir.rmdir()
                 self.send_error(400, "No files uploaded or missing form field 'files'")
                 return
+            # Report names rather than paths: files staged in RAM are removed
+            # once the ingest job finishes
+            saved_names = [filename for filename, _ in uploaded_files]
 
-            base_dir = Path(__file__).parent
-            upload_dir = base_dir / "uploads"
-            upload_dir.mkdir(exist_ok=True)
-
-            saved_files = []
-            ingested = []
-            for file_item in uploaded_files:
-                filename = file_item.filename or "uploaded_file"
-                file_content = file_item.file.read()
-
-                # Save to uploads/
-                file_path = upload_dir / filename
-                with open(file_path, 'wb') as f:
-                    f.write(file_content)
-                saved_files.append(str(file_path))
-
-                # Trigger ETL ingestion into star schema via docker compose + etl-go
-                try:
-                    cmd = [
-                        "docker", "compose", "run", "--rm",
-                        "-e", "ETL_SOURCE_TYPE=file",
-                        "-e", f"ETL_SOURCE_FILE=/app/uploads/{filename}",
-                        "-e", "ETL_MODE=star",
-                        "-v", f"{upload_dir}:/app/uploads",
-                        "etl-go"
-                    ]
-                    result = subprocess.run(
-                        cmd,
-                        cwd=base_dir,
-                        capture_output=True,
-                        text=True,
-                        check=True
-                    )
-                    ingested.append({"file": filename, "status": "ingested", "output": result.stdout})
-                except subprocess.CalledProcessError as etl_err:
-                    ingested.append({
-                        "file": filename,
-                        "status": "failed",
-                        "error": etl_err.stderr or str(etl_err)
-                    })
-
-            self.send_response(200)
-            self._set_cors()
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
+            # Ingestion runs in the background; clients poll /status/<job_id>
+            enqueue_ingest(job_id, job_dir, saved_names)
             resp = {
                 "success": True,
-                "message": f"Saved {len(saved_files)} file(s)",
-                "files": saved_files,
-                "ingest": ingested
+                "message": f"Saved {len(saved_names)} file(s), ingestion queued",
+                "files": saved_names,
+                "job_id": job_id,
+                "status_url": f"/status/{job_id}"
             }
-            self.wfile.write(json.dumps(resp).encode("utf-8"))
+            self.send_json(202, resp)
         except Exception as e:
             print("Upload error:", e)
             traceback.print_exc()
-            self.send_response(500)
-            self._set_cors()
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
             resp = {"success": False, "error": str(e)}
-            self.wfile.write(json.dumps(resp).encode("utf-8"))
+            # Part of the body may be unread, so the connection cannot be reused
+            self.send_json(500, resp, {"Connection": "close"})
 
 def start_server():
-    # Change to the web-upload directory
-    web_dir = Path(__file__).parent / "web-upload"
-    os.chdir(web_dir)
-    
     port = 8080
     
     # Create a custom handler that serves files from web-upload directory
     Handler = UploadHTTPRequestHandler
     
-    with socketserver.TCPServer(("", port), Handler) as httpd:
+    # Worker pool size, see README
+    max_workers = env_positive_int("UPLOAD_SERVER_WORKERS", PooledTCPServer.max_workers)
+    max_pending = env_positive_int("UPLOAD_SERVER_PENDING", PooledTCPServer.max_pending)
+    
+    with PooledTCPServer(("", port), Handler, max_workers=max_workers, max_pending=max_pending) as httpd:
+        # Only once the port is bound, so a second instance that fails to
+        # start cannot remove the running one's staged uploads
+        sweep_stale_staging()
+        start_ingest_worker()
         print(f"Web interface started at http://localhost:{port}/minimal_upload.html")
         print("Press Ctrl+C to stop the server")
         
@@ -0,0 +1,457 @@
+"""Helpers shared by start_web_interface.py and upload_server.py."""
+import http.server
+import io
+import json
+import os
+import re
+import shutil
+import socket
+import socketserver
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:  # optional, stdlib json is used without it
+    orjson = None
+
+CHUNK_SIZE = 64 * 1024
+WRITE_BUFSIZE = 4 << 20
+# Upload parts up to this size stay in memory; larger ones spill to disk
+SPOOL_MAX_SIZE = 1 << 20
+# Seconds a client is asked to wait after an upload is refused under load
+RETRY_AFTER = 30
+# Uploads streamed at once, independent of the worker pool size, and how
+# long a request waits for a free slot before it is refused
+MAX_CONCURRENT_UPLOADS = 4
+UPLOAD_SLOT_TIMEOUT = 5
+# Seconds a socket read may stall while a request is being received
+REQUEST_TIMEOUT = 60
+# Idle seconds a connection may wait for its next request before it is
+# closed; kept short because an idle connection still holds a pool worker
+KEEPALIVE_IDLE_TIMEOUT = 5
+
+_NAME_RE = re.compile(rb'\bname="([^"]*)"')
+_FILENAME_RE = re.compile(rb'\bfilename="([^"]*)"')
+
+
+class SendfileHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """SimpleHTTPRequestHandler that sends static files with sendfile()."""
+
+    def copyfile(self, source, outputfile):
+        if outputfile is self.wfile:
+            # socket.sendfile() uses os.sendfile for regular files and falls
+            # back to send() for anything else
+            self.wfile.flush()
+            self.connection.sendfile(source)
+        else:
+            super().copyfile(source, outputfile)
+
+
+# Shared by every handler in the process; each script runs a single server
+upload_sem = threading.BoundedSemaphore(MAX_CONCURRENT_UPLOADS)
+
+
+class BaseUploadHTTPRequestHandler(SendfileHTTPRequestHandler):
+    """Request handler base shared by both upload servers.
+
+    Serves keep-alive connections with a short idle timeout, admits POST
+    /upload under upload_sem and the subclass's upload_refusal() check (before
+    100 Continue when the client asks for it), then calls handle_file_upload(),
+    which subclasses must provide.
+    """
+
+    timeout = REQUEST_TIMEOUT
+    idle_timeout = KEEPALIVE_IDLE_TIMEOUT
+    upload_admitted = False
+
+    def handle(self):
+        try:
+            while self._wait_for_request():
+                self.handle_one_request()
+                if self.close_connection:
+                    break
+        finally:
+            # A slot taken in handle_expect_100 is still held if writing
+            # 100 Continue failed and do_POST never ran
+            self._release_upload()
+
+    def _wait_for_request(self):
+        # Only the wait for the next request line uses the short idle timeout
+        self.connection.settimeout(self.idle_timeout)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def upload_refusal(self, content_length):
+        """Return why an upload of content_length bytes must wait, or None."""
+        return None
+
+    def admit_upload(self):
+        """Take an upload slot and run upload_refusal(); on refusal reply and return False."""
+        try:
+            content_length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            self.send_error(411, "Content-Length required")
+            return False
+        if not upload_sem.acquire(timeout=UPLOAD_SLOT_TIMEOUT):
+            self.send_busy("Too many uploads in progress, retry later")
+            return False
+        try:
+            message = self.upload_refusal(content_length)
+        except BaseException:
+            upload_sem.release()
+            raise
+        if message:
+            upload_sem.release()
+            self.send_busy(message)
+            return False
+        self.upload_admitted = True
+        return True
+
+    def _release_upload(self):
+        if self.upload_admitted:
+            self.upload_admitted = False
+            upload_sem.release()
+
+    def handle_expect_100(self):
+        # Refuse before the client starts sending the body, not after
+        if self.command == 'POST' and self.path == '/upload' and not self.admit_upload():
+            return False
+        return super().handle_expect_100()
+
+    def do_POST(self):
+        if self.path != '/upload':
+            self.send_error(404, "Not Found")
+            return
+        if not self.upload_admitted and not self.admit_upload():
+            return
+        try:
+            self.handle_file_upload()
+        finally:
+            self._release_upload()
+
+    def send_json(self, code, payload, headers=None):
+        body = json_bytes(payload)
+        self.send_response(code)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_busy(self, message):
+        # The request body is left unread, so the connection cannot be reused
+        self.send_json(503, {"success": False, "error": message},
+                       {"Retry-After": str(RETRY_AFTER), "Connection": "close"})
+
+
+def json_bytes(obj):
+    """Serialize obj to UTF-8 JSON bytes, using orjson when installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+
+def env_positive_int(name, default):
+    """Read a positive integer setting from the environment, or exit with an error."""
+    value = os.environ.get(name, "").strip()
+    if not value:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise SystemExit(f"{name} must be a positive integer, got {value!r}")
+    return number
+
+
+class PooledTCPServer(socketserver.TCPServer):
+    """TCP server that handles requests on a bounded pool of worker threads.
+
+    A slow upload no longer blocks other clients, and at most
+    max_workers + max_pending connections are accepted at once, so a burst
+    of clients cannot spawn an unbounded number of threads.
+    """
+
+    allow_reuse_address = True
+    # Uploads spend their time blocked on socket and disk I/O, which releases
+    # the GIL, so the pool can be sized well past the CPU count
+    max_workers = 16
+    max_pending = 64
+
+    def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True,
+                 max_workers=None, max_pending=None):
+        if max_workers is not None:
+            self.max_workers = max_workers
+        if max_pending is not None:
+            self.max_pending = max_pending
+        # Set up before binding: TCPServer calls server_close() if bind fails
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._slots = threading.BoundedSemaphore(self.max_workers + self.max_pending)
+        self._active = set()
+        self._active_lock = threading.Lock()
+        super().__init__(server_address, RequestHandlerClass, bind_and_activate)
+
+    def get_request(self):
+        request, client_address = super().get_request()
+        # Send small JSON replies immediately and detect dead peers. Socket
+        # buffer sizes are left to the kernel: setting SO_RCVBUF/SO_SNDBUF
+        # disables Linux autotuning, which grows them further for large uploads
+        request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        request.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        return request, client_address
+
+    def process_request(self, request, client_address):
+        # Block the accept loop once the pool and its queue are full
+        self._slots.acquire()
+        try:
+            self._executor.submit(self._process_pooled, request, client_address)
+        except BaseException:
+            self._slots.release()
+            self.shutdown_request(request)
+            raise
+
+    def _process_pooled(self, request, client_address):
+        with self._active_lock:
+            self._active.add(request)
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            with self._active_lock:
+                self._active.discard(request)
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def server_close(self):
+        super().server_close()
+        # Pool workers are joined at interpreter exit, so unblock handlers
+        # still reading from idle or in-flight connections
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        with self._active_lock:
+            active = list(self._active)
+        for request in active:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class MultipartStreamParser:
+    """Incremental multipart/form-data parser.
+
+    Body bytes are fed in with data_received() as they arrive. For every part
+    on_part(headers) is called with the raw header block and may return a
+    sink to receive the part body, or None to skip it. A sink needs write(),
+    close(), called once the part's closing delimiter is seen, and discard(),
+    called by close() on the parser when the body ends mid-part.
+    Memory use is bounded by the chunk size rather than the body size.
+    """
+
+    MAX_HEADER_SIZE = 16 * 1024
+
+    def __init__(self, boundary, on_part):
+        self._first = b'--' + boundary
+        self._delimiter = b'\r\n--' + boundary
+        self._on_part = on_part
+        self._buf = bytearray()
+        self._state = 'preamble'
+        self._sink = None
+
+    def data_received(self, data):
+        self._buf += data
+        # Scan with an offset and hand out memoryview slices, then drop the
+        # consumed prefix once per call instead of copying every part
+        with memoryview(self._buf) as mv:
+            pos = self._scan(mv)
+        del self._buf[:pos]
+
+    def _scan(self, mv):
+        buf = self._buf
+        pos = 0
+        while True:
+            if self._state == 'preamble':
+                idx = buf.find(self._first, pos)
+                if idx == -1:
+                    return max(pos, len(buf) - len(self._first) + 1)
+                pos = idx + len(self._first)
+                self._state = 'boundary'
+            elif self._state == 'boundary':
+                if len(buf) - pos < 2:
+                    return pos
+                if buf.startswith(b'--', pos):
+                    self._state = 'done'
+                    return len(buf)
+                if not buf.startswith(b'\r\n', pos):
+                    raise ValueError("Malformed multipart boundary")
+                pos += 2
+                self._state = 'headers'
+            elif self._state == 'headers':
+                idx = buf.find(b'\r\n\r\n', pos)
+                if idx == -1:
+                    if len(buf) - pos > self.MAX_HEADER_SIZE:
+                        raise ValueError("Multipart part headers too large")
+                    return pos
+                headers = bytes(mv[pos:idx])
+                pos = idx + 4
+                self._sink = self._on_part(headers)
+                self._state = 'body'
+            elif self._state == 'body':
+                # bytearray.find (two-way search) scans ~3x faster than a
+                # compiled re.escape() pattern and already copies nothing
+                idx = buf.find(self._delimiter, pos)
+                if idx == -1:
+                    # Keep enough of the tail to match a delimiter split across chunks
+                    end = max(pos, len(buf) - len(self._delimiter) + 1)
+                    if self._sink is not None and end > pos:
+                        self._sink.write(mv[pos:end])
+                    return end
+                if self._sink is not None:
+                    self._sink.write(mv[pos:idx])
+                    self._sink.close()
+                    self._sink = None
+                pos = idx + len(self._delimiter)
+                self._state = 'boundary'
+            else:
+                return len(buf)
+
+    @property
+    def done(self):
+        return self._state == 'done'
+
+    def close(self):
+        if self._sink is not None:
+            self._sink.discard()
+            self._sink = None
+
+
+def read_multipart(rfile, content_length, boundary, on_part):
+    """Stream content_length bytes of a multipart body from rfile through a parser."""
+    parser = MultipartStreamParser(boundary, on_part)
+    # One read buffer sized from Content-Length, reused for every chunk
+    buf = bytearray(min(CHUNK_SIZE, content_length))
+    mv = memoryview(buf)
+    try:
+        remaining = content_length
+        while remaining > 0:
+            n = rfile.readinto(mv[:min(len(buf), remaining)])
+            if not n:
+                break
+            remaining -= n
+            parser.data_received(mv[:n])
+    finally:
+        parser.close()
+    if not parser.done:
+        raise ValueError("Incomplete multipart body")
+
+
+def has_disk_room(path, content_length):
+    """Return True if path's filesystem can take content_length bytes twice over.
+
+    Refusing uploads before the disk fills keeps a saturated disk from slowing
+    every response and provoking larger client retries.
+    """
+    return shutil.disk_usage(path).free >= content_length * 2
+
+
+def multipart_boundary(headers):
+    """Return the boundary of a multipart request as bytes.
+
+    headers is the request's http.client.HTTPMessage; its parameter parser
+    handles quoting and extra Content-Type parameters.
+    """
+    boundary = headers.get_boundary()
+    if not boundary:
+        raise ValueError("Missing multipart boundary")
+    return boundary.encode('latin-1')
+
+
+def parse_content_disposition(headers):
+    """Return the (name, filename) of a part from its raw header block.
+
+    The header block is searched as bytes; only the matched values are decoded.
+    """
+    name = _NAME_RE.search(headers)
+    filename = _FILENAME_RE.search(headers)
+    return (name.group(1).decode('utf-8', errors='ignore') if name else None,
+            filename.group(1).decode('utf-8', errors='ignore') if filename else None)
+
+
+class UploadWriter(io.BufferedWriter):
+    """Buffered writer for a new upload file; fails if path already exists.
+
+    Uses a 4 MB buffer so large files go out in few write() calls. The pages
+    are left in the page cache, since the ingest worker reads them next.
+    """
+
+    def __init__(self, path):
+        super().__init__(io.FileIO(path, 'xb'), buffer_size=WRITE_BUFSIZE)
+
+
+class SpooledUpload:
+    """Write target for one upload part, saved to path once the part is complete.
+
+    Data is kept in memory until it exceeds max_size, then spilled to a
+    temporary file next to path. close(), called when the part's closing
+    delimiter is seen, renames the temporary file into place, so path only
+    ever holds a complete upload; discard() drops a part whose body was cut
+    off, leaving any existing file at path intact.
+    """
+
+    def __init__(self, path, max_size=SPOOL_MAX_SIZE):
+        self.path = os.fspath(path)
+        self._max_size = max_size
+        self._file = io.BytesIO()
+        self._spill_path = None
+        self.size = 0
+        self.saved = False
+
+    def write(self, data):
+        if self._spill_path is None and self.size + len(data) > self._max_size:
+            self._rollover()
+        self._file.write(data)
+        self.size += len(data)
+
+    def _rollover(self):
+        directory, name = os.path.split(self.path)
+        self._spill_path = os.path.join(directory, f".{name}.{uuid.uuid4().hex}.part")
+        spill = UploadWriter(self._spill_path)
+        spill.write(self._file.getbuffer())
+        self._file = spill
+
+    def close(self):
+        if self._file is None:
+            return
+        try:
+            if self._spill_path is None:
+                self._rollover()
+            # Same directory, so this is a rename rather than a copy
+            self._file.close()
+            os.replace(self._spill_path, self.path)
+        except BaseException:
+            self.discard()
+            raise
+        self._file = None
+        self.saved = True
+
+    def discard(self):
+        if self._file is None:
+            return
+        try:
+            self._file.close()
+        except OSError:
+            pass
+        if self._spill_path is not None:
+            try:
+                os.unlink(self._spill_path)
+            except FileNotFoundError:
+                pass
+        self._file = None